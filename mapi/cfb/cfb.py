@@ -1,11 +1,13 @@
 import io
+import logging
+import struct
 from abc import abstractmethod
 from math import pow
 
 from mapi.util.decoder import *
 from mapi.util.logger import log
 
-__all__ = ['Cfb', 'ROOT_ENTRY']
+__all__ = ['Cfb', 'CfbStreamReader', 'ROOT_ENTRY']
 
 HEADER_SIZE = 512
 HEADER_SIGNATURE = b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"
@@ -20,6 +22,7 @@ SECTOR_SIZE_3 = 512
 VERSION_4 = 4
 SECTOR_SIZE_4 = 4096
 MINI_SECTOR_SIZE = 64
+STREAM_CHUNK_SIZE = 65536
 
 OBJ_TYPE_UNALLOCATED = 0
 OBJ_TYPE_STORAGE = 1
@@ -117,7 +120,7 @@ class CfbDiFat:
 
     def __init__(self, _data):
         self.difat = _data
-        log.debug("difat: %s" % self.difat)
+        log.debug("difat: %s", self.difat)
 
 
 class CfbFatBase:
@@ -127,7 +130,7 @@ class CfbFatBase:
         self.fat = _data
         self.sector_size = sector_size
         self.type = _type
-        log.debug("fat (%d): %s" % (self.sector_size, self.fat))
+        log.debug("fat (%d): %s", self.sector_size, self.fat)
 
     @abstractmethod
     def offset(self, sector_number):
@@ -154,17 +157,13 @@ class CfbDirectory:
     def __init__(self, _data):
         self.entries = _data
         assert (_data[0].object_type() == OBJ_TYPE_ROOT_STORAGE)
-        log.debug("directory entries: %d" % len(_data))
+        log.debug("directory entries: %d", len(_data))
+        debug = log.isEnabledFor(logging.DEBUG)
         for i in range(0, len(self.entries)):
             self.entries[i].index = i
-            self.entries[i].info()
-        self._make_tree()
-
-    def _make_tree(self):
-        log.debug("make tree")
-        for entry in self.entries:
-            if entry.object_type() in (OBJ_TYPE_STORAGE, OBJ_TYPE_ROOT_STORAGE):
-                entry.set_children(self.add_children(entry))
+            self.entries[i].directory = self
+            if debug:
+                self.entries[i].info()
 
     def add_children(self, entry):
         children = []
@@ -219,13 +218,23 @@ class CfbDirectory:
 
 
 class CfbStorage:
-    __slots__ = ['index', 'data', 'children']
+    __slots__ = ['index', 'data', '_children', 'names', 'directory']
 
     def __init__(self, _data):
         self.data = _data
-        self.children = None
+        self._children = None
+        self.names = None
+        self.directory = None
         self.index = 0
 
+    @property
+    def children(self):
+        # the children of a storage are collected from the red-black tree on first use
+        if self._children is None and self.directory is not None and \
+                self.object_type() in (OBJ_TYPE_STORAGE, OBJ_TYPE_ROOT_STORAGE):
+            self._children = self.directory.add_children(self)
+        return self._children
+
     def info(self):
         log.debug("/---")
         log.debug("index: %d name: %s type: %d (%s)" %
@@ -237,7 +246,7 @@ class CfbStorage:
         log.debug("stream size: %d" % self.stream_size())
 
     def set_children(self, children):
-        self.children = children
+        self._children = children
 
     def directory_entry_name(self):
         length = self.directory_entry_name_length()
@@ -271,20 +280,61 @@ class CfbStorage:
 
 
 class CfbMiniStream:
-    __slots__ = ['stream']
+    """
+    Mini stream sectors, the regular sectors holding them are read on first use
+    """
+    __slots__ = ['cfb', 'sectors', 'cache']
+
+    def __init__(self, cfb, sectors):
+        self.cfb = cfb
+        self.sectors = sectors
+        self.cache = dict()
 
-    def __init__(self, data):
-        self.stream = data
+    def file_offset(self, sector):
+        index, offset = divmod(sector * self.cfb.mini_sector_size, self.cfb.sector_size)
+        return self.cfb.offset(self.sectors[index], self.cfb.sector_size) + offset
 
     def read_sector(self, sector):
-        return self.stream[sector]
+        mini_sector_size = self.cfb.mini_sector_size
+        index, offset = divmod(sector * mini_sector_size, self.cfb.sector_size)
+        _data = self.cache.get(index, None)
+        if _data is None:
+            _data = self.cfb._read_file_sector(self.sectors[index])
+            self.cache[index] = _data
+        return _data[offset:offset + mini_sector_size]
+
+
+class CfbStreamReader(io.RawIOBase):
+    """
+    Sequential file-like reader over a CFB stream, reading at most
+    `chunk_size` bytes from the underlying file at a time
+    """
+
+    def __init__(self, cfb, stream, chunk_size=STREAM_CHUNK_SIZE):
+        super().__init__()
+        self.chunks = cfb.iter_stream(stream, chunk_size)
+        self.buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = memoryview(chunk)
+        size = min(len(b), len(self.buffer))
+        b[0:size] = self.buffer[0:size]
+        self.buffer = self.buffer[size:]
+        return size
 
 
 class Cfb:
     __slots__ = ['fp', 'sector_size', 'mini_sector_size', 'cfb_header', 'cfb_root',
-                 'cfb_difat', 'cfb_fat', 'cfb_mini_fat', 'cfb_mini_stream']
+                 'cfb_difat', 'cfb_fat', 'cfb_mini_fat', 'cfb_mini_stream', 'cfb_streams']
 
-    def __init__(self, fp):
+    def __init__(self, fp, index=None):
         self.fp = fp
         self.sector_size = SECTOR_SIZE_3
         self.mini_sector_size = MINI_SECTOR_SIZE
@@ -294,7 +344,11 @@ class Cfb:
         self.cfb_fat = None
         self.cfb_mini_fat = None
         self.cfb_mini_stream = None
-        self._init()
+        self.cfb_streams = dict()
+        if index is None:
+            self._init()
+        else:
+            self._load(index)
 
     def _init(self):
         self._header()
@@ -304,6 +358,18 @@ class Cfb:
         self._root_entry()
         self._mini_stream()
 
+    def _load(self, index):
+        # structures parsed earlier (see CfbIndex), the file is read only for stream data
+        self.cfb_header = CfbHeader(index.header)
+        self.sector_size = self.cfb_header.sector_size()
+        self.mini_sector_size = self.cfb_header.mini_stream_sector_size()
+        self.cfb_fat = CfbFat(index.fat, self.sector_size)
+        self.cfb_mini_fat = CfbMiniFat(index.mini_fat, self.mini_sector_size, 0)
+        self.cfb_root = CfbDirectory([CfbStorage(_data) for _data in index.entries])
+        if self.cfb_root.root().stream_size() > 0:
+            self.cfb_mini_stream = CfbMiniStream(self, index.mini_sectors)
+        self.cfb_streams = index.streams
+
     def select_fat(self, stream_size):
         size_cutoff = self.cfb_header.mini_stream_size_cutoff()
         return self.cfb_mini_fat if stream_size < size_cutoff else self.cfb_fat
@@ -378,6 +444,10 @@ class Cfb:
         if stream_size == 0:
             return None
 
+        _data = self.cfb_streams.get(stream.index, None)
+        if _data is not None:
+            return _data
+
         buffer = []
         fat_obj = self.select_fat(stream_size)
         _start = stream.starting_sector()
@@ -392,6 +462,72 @@ class Cfb:
 
         return b"".join(buffer)[0:stream_size]
 
+    def stream_extents(self, stream):
+        # runs of consecutive regular sectors as (file offset, length)
+        fat = self.cfb_fat.fat
+        _start = stream.starting_sector()
+        while _start != ENDOFCHAIN:
+            first, count = _start, 1
+            _start = fat[_start]
+            while _start == first + count:
+                count += 1
+                _start = fat[_start]
+            yield self.offset(first, self.sector_size), count * self.sector_size
+
+    def file_extents(self, stream):
+        # (file offset, length) runs holding the stream data, clipped to the stream size
+        remaining = stream.stream_size()
+        if remaining == 0:
+            return []
+
+        if self.select_fat(remaining) is self.cfb_mini_fat:
+            runs = []
+            _start = stream.starting_sector()
+            while _start != ENDOFCHAIN:
+                runs.append((self.cfb_mini_stream.file_offset(_start), self.mini_sector_size))
+                _start = self.cfb_mini_fat.fat[_start]
+        else:
+            runs = self.stream_extents(stream)
+
+        extents = []
+        for offset, length in runs:
+            length = min(length, remaining)
+            remaining -= length
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((offset, length))
+            if remaining == 0:
+                break
+        return extents
+
+    def iter_stream(self, stream, chunk_size=STREAM_CHUNK_SIZE):
+        if stream is None:
+            return
+
+        assert (stream.object_type() == OBJ_TYPE_STREAM)
+
+        stream_size = stream.stream_size()
+        if stream_size == 0:
+            return
+
+        if self.select_fat(stream_size) is self.cfb_mini_fat:
+            yield self._read_stream(stream)
+            return
+
+        remaining = stream_size
+        for offset, length in self.stream_extents(stream):
+            length = min(length, remaining)
+            remaining -= length
+            while length > 0:
+                size = min(length, chunk_size)
+                self.fp.seek(offset, io.SEEK_SET)
+                yield self.fp.read(size)
+                offset += size
+                length -= size
+            if remaining == 0:
+                break
+
     def _mini_stream(self):
         root = self.cfb_root.root()
         assert (root.object_type() == OBJ_TYPE_ROOT_STORAGE)
@@ -400,17 +536,15 @@ class Cfb:
         if stream_size == 0:
             return None
 
-        buffer = []
+        sectors = []
         _start = root.starting_sector()
 
         while _start != ENDOFCHAIN:
-            buffer.append(self._read_file_sector(_start))
+            sectors.append(_start)
             _next = self.cfb_fat.fat[_start]
             _start = _next
 
-        _data = b"".join(buffer)[0:stream_size]
-        self.cfb_mini_stream = CfbMiniStream([_data[i:i + self.mini_sector_size]
-                                              for i in range(0, len(_data), self.mini_sector_size)])
+        self.cfb_mini_stream = CfbMiniStream(self, sectors)
 
     def _read_sector(self, fat_obj, sector_number):
         offset, sector_size = fat_obj.offset(sector_number)
@@ -422,17 +556,33 @@ class Cfb:
         self.fp.seek(offset, io.SEEK_SET)
         return self.fp.read(self.sector_size)
 
+    def children_index(self, root):
+        if root.names is None:
+            names = dict()
+            for child in root.children:
+                entry = self.cfb_root.entry(child)
+                names.setdefault(entry.directory_entry_name(), entry)
+            root.names = names
+        return root.names
+
     def find_stream(self, root, property_name):
-        for child in root.children:
-            entry = self.cfb_root.entry(child)
-            if entry.directory_entry_name() == property_name:
-                return entry
-        return None
+        return self.children_index(root).get(property_name, None)
 
     def read_stream(self, root, property_name):
         stm = self.find_stream(root, property_name)
         return None if stm is None else self._read_stream(stm)
 
+    def read_streams(self, streams):
+        # read mini streams first, then regular streams in sector order
+        order = sorted((i for i, stream in enumerate(streams)
+                        if stream is not None and stream.object_type() == OBJ_TYPE_STREAM),
+                       key=lambda i: (self.select_fat(streams[i].stream_size()) is self.cfb_fat,
+                                      streams[i].starting_sector()))
+        buffer = [None] * len(streams)
+        for i in order:
+            buffer[i] = self._read_stream(streams[i])
+        return buffer
+
     def dump(self, root):
         print(root.directory_entry_name())
         for child in root.children:
@@ -446,5 +596,4 @@ class Cfb:
 
     @staticmethod
     def split(fat_data):
-        return [uint32(fat_data[i:i + FAT_ENTRY_SIZE])
-                for i in range(0, len(fat_data), FAT_ENTRY_SIZE)]
+        return list(struct.unpack("<%dI" % (len(fat_data) // FAT_ENTRY_SIZE), fat_data))
@@ -0,0 +1,158 @@
+"""
+Sidecar cache of parsed CFB structures
+
+An index file holds the CFB header, FAT, MiniFAT, mini stream sector chain,
+directory entries and selected small streams of one compound file. It is
+memory mapped on load, so re-opening a cached file reads only the streams it needs.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from mapi.cfb.cfb import Cfb, DIR_ENTRY_SIZE, OBJ_TYPE_STREAM
+from mapi.util.logger import log
+
+__all__ = ['CfbIndex', 'CfbIndexCache']
+
+INDEX_MAGIC = b"MAPIIDX\x01"
+# magic, CFB header, FAT, MiniFAT, mini stream sectors, directory entries and streams counts
+INDEX_HEADER = struct.Struct("<8s512sIIIII")
+# directory entry index, stream size
+INDEX_STREAM = struct.Struct("<II")
+
+
+def _uint32_array(view):
+    if sys.byteorder == "little":
+        return view.cast("I")
+    values = array("I", view)
+    values.byteswap()
+    return values
+
+
+class CfbIndex:
+    __slots__ = ['header', 'fat', 'mini_fat', 'mini_sectors', 'entries', 'streams']
+
+    def __init__(self, header, fat, mini_fat, mini_sectors, entries, streams):
+        self.header = header
+        self.fat = fat
+        self.mini_fat = mini_fat
+        self.mini_sectors = mini_sectors
+        self.entries = entries
+        self.streams = streams
+
+    @staticmethod
+    def from_cfb(cfb, preload=()):
+        entries = cfb.cfb_root.entries
+        streams = dict()
+        for entry in entries:
+            if entry.object_type() == OBJ_TYPE_STREAM and entry.directory_entry_name() in preload:
+                _data = cfb._read_stream(entry)
+                if _data is not None:
+                    streams[entry.index] = _data
+        mini_sectors = [] if cfb.cfb_mini_stream is None else cfb.cfb_mini_stream.sectors
+        return CfbIndex(cfb.cfb_header.header, cfb.cfb_fat.fat, cfb.cfb_mini_fat.fat, mini_sectors,
+                        [entry.data for entry in entries], streams)
+
+    @staticmethod
+    def from_buffer(buffer):
+        view = memoryview(buffer)
+        magic, header, n_fat, n_mini_fat, n_mini_sectors, n_entries, n_streams = \
+            INDEX_HEADER.unpack_from(view, 0)
+        if magic != INDEX_MAGIC:
+            return None
+
+        offset = INDEX_HEADER.size
+        size = offset + 4 * (n_fat + n_mini_fat + n_mini_sectors) + n_entries * DIR_ENTRY_SIZE + \
+            n_streams * INDEX_STREAM.size
+        if size > len(view):
+            raise ValueError("truncated index")
+
+        arrays = []
+        for count in (n_fat, n_mini_fat, n_mini_sectors):
+            arrays.append(_uint32_array(view[offset:offset + 4 * count]))
+            offset += 4 * count
+
+        entries = [bytes(view[i:i + DIR_ENTRY_SIZE])
+                   for i in range(offset, offset + n_entries * DIR_ENTRY_SIZE, DIR_ENTRY_SIZE)]
+        offset += n_entries * DIR_ENTRY_SIZE
+
+        table = list(INDEX_STREAM.iter_unpack(view[offset:offset + n_streams * INDEX_STREAM.size]))
+        offset += n_streams * INDEX_STREAM.size
+        if offset + sum(size for index, size in table) > len(view):
+            raise ValueError("truncated index")
+
+        streams = dict()
+        for index, size in table:
+            streams[index] = bytes(view[offset:offset + size])
+            offset += size
+
+        return CfbIndex(header, arrays[0], arrays[1], arrays[2], entries, streams)
+
+    def to_bytes(self):
+        buffer = [INDEX_HEADER.pack(INDEX_MAGIC, bytes(self.header), len(self.fat), len(self.mini_fat),
+                                    len(self.mini_sectors), len(self.entries), len(self.streams))]
+        for values in (self.fat, self.mini_fat, self.mini_sectors):
+            buffer.append(struct.pack("<%dI" % len(values), *values))
+        buffer.extend(bytes(entry) for entry in self.entries)
+        buffer.extend(INDEX_STREAM.pack(index, len(_data)) for index, _data in self.streams.items())
+        buffer.extend(self.streams.values())
+        return b"".join(buffer)
+
+
+class CfbIndexCache:
+    """
+    Directory of index files, keyed by (path, size, mtime) or by a content digest
+    """
+    __slots__ = ['directory']
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, fp, key=None, preload=()):
+        if key is None:
+            key = self.content_key(fp)
+        path = os.path.join(self.directory, "%s.idx" % key)
+        index = self.load(path)
+        if index is not None:
+            return Cfb(fp, index)
+        cfb = Cfb(fp)
+        self.save(path, CfbIndex.from_cfb(cfb, preload))
+        return cfb
+
+    @staticmethod
+    def load(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as fp:
+            try:
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                return CfbIndex.from_buffer(buffer)
+            except (ValueError, struct.error) as e:
+                log.error("Invalid index %s: %s" % (path, e))
+                return None
+
+    def save(self, path, index):
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as fp:
+            fp.write(index.to_bytes())
+        os.replace(fp.name, path)
+
+    @staticmethod
+    def path_key(path):
+        stat = os.stat(path)
+        key = "%s\0%d\0%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def content_key(fp):
+        digest = hashlib.sha256()
+        fp.seek(0)
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+        fp.seek(0)
+        return digest.hexdigest()
@@ -1,6 +1,7 @@
 import os
 from io import BytesIO
 
+from mapi.cfb.cfb_index import CfbIndexCache
 from mapi.msg.msg import Msg
 from mapi.wrx.wrx import Wrx
 from mapi.pst.pst import Pst
@@ -9,12 +10,13 @@ MAX_MEMORY_MSG_FILE_LENGTH = 50000000
 
 
 class MApi:
-    __slots__ = ['file_path', 'ext', 'fp', 'stream']
+    __slots__ = ['file_path', 'ext', 'fp', 'stream', 'index_cache']
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, index_cache=None):
         self.file_path = file_path
         self.ext = self.file_path.split('.')[-1].lower()
         self.stream = None
+        self.index_cache = index_cache
 
     def __enter__(self):
         file_size = os.path.getsize(self.file_path)
@@ -35,6 +37,8 @@ class MApi:
 
     def select(self, stream):
         if self.ext == 'msg':
+            if self.index_cache is not None:
+                return Msg(stream, self.index_cache, CfbIndexCache.path_key(self.file_path))
             return self.ns_msg(stream)
         elif self.ext == 'wrx':
             return self.ns_wrx(stream)
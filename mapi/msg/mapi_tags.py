@@ -7,7 +7,8 @@ __all__ = ['PidTagAttachDataBinary', 'PidTagAttachDataObject', 'PidTagDisplayNam
            'PidTagSenderSmtpAddress', 'PidTagAttachContentId', 'PidTagRecipientDisplayName', 'PidTagHasAttachments',
            'PidTagMessageDeliveryTime', 'PidTagObjectType', 'PidTagAttachMethod', 'PidTagRtfInSync',
            'PidTagNameidStreamGuid', 'PidTagNameidStreamEntry', 'PidTagNameidStreamString', 'PidTagInternetMessageId',
-           'PidTagClientSubmitTime', 'PidTagReceiptTime', 'PidTagDisplayCc', 'PidTagDisplayBcc']
+           'PidTagClientSubmitTime', 'PidTagReceiptTime', 'PidTagDisplayCc', 'PidTagDisplayBcc',
+           'PidTagAttachFilename', 'PidTagInternetCodepage', 'PidTagMessageCodepage']
 
 PidTagNameidBucketCount = 0x0001
 PidTagNameidStreamGuid = 0x0002
@@ -111,3 +112,5 @@ PidTagRecipientEntryId = 0x5FF7
 PidTagRtfInSync = 0x0E1F
 PidTagInternetMessageId = 0x1035
 PidTagReceiptTime = 0x002A
+PidTagInternetCodepage = 0x3FDE
+PidTagMessageCodepage = 0x3FFD
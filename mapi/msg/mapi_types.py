@@ -1,7 +1,11 @@
-__all__ = ['PtypInteger32', 'PtypBoolean', 'PtypObject', 'PtypString8',
-           'PtypString', 'PtypBinary', 'PtypMultipleInteger32',
-           'PtypMultipleString8', 'PtypMultipleString', 'PtypMultipleBinary',
-           'PtypTime']
+__all__ = ['PtypInteger16', 'PtypInteger32', 'PtypFloating32', 'PtypFloating64', 'PtypCurrency',
+           'PtypFloatingTime', 'PtypErrorCode', 'PtypBoolean', 'PtypInteger64', 'PtypString',
+           'PtypString8', 'PtypTime', 'PtypGuid', 'PtypServerId', 'PtypRestriction',
+           'PtypRuleAction', 'PtypBinary', 'PtypMultipleInteger16', 'PtypMultipleInteger32',
+           'PtypMultipleFloating32', 'PtypMultipleFloating64', 'PtypMultipleCurrency',
+           'PtypMultipleFloatingTime', 'PtypMultipleInteger64', 'PtypMultipleString',
+           'PtypMultipleString8', 'PtypMultipleTime', 'PtypMultipleGuid', 'PtypMultipleBinary',
+           'PtypUnspecified', 'PtypNull', 'PtypObject']
 
 PtypInteger16 = 0x0002
 PtypInteger32 = 0x0003
@@ -0,0 +1,168 @@
+import codecs
+import sys
+from array import array
+from collections.abc import Sequence
+
+from mapi.msg.mapi_types import *
+from mapi.util.decoder import *
+from mapi.util.time import *
+
+__all__ = ['MsgValues', 'FIXED_DECODERS', 'STREAM_DECODERS', 'MULTIPLE_DECODERS',
+           'MULTIPLE_LENGTH_SIZE', 'DEFAULT_CODEC', 'multiple_offsets', 'string8', 'codepage_codec']
+
+DEFAULT_CODEPAGE = 1252
+
+# Windows code pages whose Python codec is not named cp<code page>
+CODEPAGES = {
+    1200: "utf-16-le",
+    1201: "utf-16-be",
+    10000: "mac_roman",
+    20127: "ascii",
+    20866: "koi8_r",
+    21866: "koi8_u",
+    28591: "latin_1",
+    28592: "iso8859_2",
+    28593: "iso8859_3",
+    28594: "iso8859_4",
+    28595: "iso8859_5",
+    28596: "iso8859_6",
+    28597: "iso8859_7",
+    28598: "iso8859_8",
+    28599: "iso8859_9",
+    28603: "iso8859_13",
+    28605: "iso8859_15",
+    50220: "iso2022_jp",
+    50221: "iso2022_jp_ext",
+    50222: "iso2022_jp",
+    50225: "iso2022_kr",
+    51932: "euc_jp",
+    51936: "gb2312",
+    51949: "euc_kr",
+    52936: "hz",
+    54936: "gb18030",
+    65000: "utf-7",
+    65001: "utf-8",
+}
+
+
+def codepage_codec(codepage):
+    try:
+        return codecs.lookup(CODEPAGES.get(codepage, "cp%d" % codepage))
+    except LookupError:
+        return None
+
+
+DEFAULT_CODEC = codepage_codec(DEFAULT_CODEPAGE)
+
+
+class MsgValues(Sequence):
+    """
+    Multi-valued property packed in a single buffer, elements are decoded on access
+    """
+    __slots__ = ['buffer', 'offsets', 'decoder']
+
+    def __init__(self, buffer, offsets, decoder=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.decoder = decoder
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        value = self.buffer[self.offsets[item]:self.offsets[item + 1]]
+        return value if self.decoder is None else self.decoder(value)
+
+    def __repr__(self):
+        return "MsgValues(%r)" % list(self)
+
+
+def _array(code):
+    def decode(data):
+        values = array(code)
+        values.frombytes(data[0:len(data) - len(data) % values.itemsize])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    return decode
+
+
+def _guids(data):
+    return MsgValues(memoryview(data), range(0, len(data) - len(data) % 16 + 1, 16), guid)
+
+
+def _string(data):
+    return None if data is None else utf16(bytes(data)).rstrip("\x00")
+
+
+def string8(data, codec=DEFAULT_CODEC):
+    # the codec decodes bytes or memoryview slices in place
+    return None if data is None else codec.decode(data, "replace")[0].rstrip("\x00")
+
+
+def _string8(data):
+    return string8(data)
+
+
+def multiple_offsets(lengths):
+    offsets = array("Q", [0])
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    return offsets
+
+
+# decoders of the 8-byte value of fixed length properties
+FIXED_DECODERS = {
+    PtypInteger16: lambda value: int16(value[0:2]),
+    PtypInteger32: lambda value: int32(value[0:4]),
+    PtypFloating32: lambda value: float(value[0:4]),
+    PtypFloating64: lambda value: double(value[0:8]),
+    PtypCurrency: lambda value: int64(value[0:8]),
+    PtypFloatingTime: lambda value: double(value[0:8]),
+    PtypErrorCode: lambda value: uint32(value[0:4]),
+    PtypBoolean: lambda value: uint8(value[0:1]),
+    PtypInteger64: lambda value: int64(value[0:8]),
+    PtypTime: lambda value: filetime2datetime(int64(value[0:8])),
+}
+
+# decoders of variable length and multi-valued fixed length properties stored in one stream
+STREAM_DECODERS = {
+    PtypString: utf16,
+    PtypString8: _string8,
+    PtypBinary: None,
+    PtypGuid: guid,
+    PtypServerId: None,
+    PtypRestriction: None,
+    PtypRuleAction: None,
+    PtypMultipleInteger16: _array("h"),
+    PtypMultipleInteger32: _array("i"),
+    PtypMultipleFloating32: _array("f"),
+    PtypMultipleFloating64: _array("d"),
+    PtypMultipleCurrency: _array("q"),
+    PtypMultipleFloatingTime: _array("d"),
+    PtypMultipleInteger64: _array("q"),
+    PtypMultipleTime: _array("q"),
+    PtypMultipleGuid: _guids,
+}
+
+# element decoders of multi-valued variable length properties, stored as a
+# length stream and one stream per element
+MULTIPLE_DECODERS = {
+    PtypMultipleString: _string,
+    PtypMultipleString8: _string8,
+    PtypMultipleBinary: None,
+}
+
+# size of an entry in the length stream of multi-valued variable length properties
+MULTIPLE_LENGTH_SIZE = {
+    PtypMultipleString: 4,
+    PtypMultipleString8: 4,
+    PtypMultipleBinary: 8,
+}
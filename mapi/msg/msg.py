@@ -1,15 +1,25 @@
+import hashlib
+import io
+import re
+import struct
+import sys
+from collections.abc import Mapping
+
 from mapi.cfb.cfb import *
 from mapi.msg.mapi_tags import *
 from mapi.msg.mapi_types import *
-from mapi.rtf.rtf import decompress
+from mapi.msg.mapi_values import *
+from mapi.rtf.rtf import decompress, decompress_iter
 from mapi.rtf.rtf_decoder import *
 from mapi.util.crc32 import *
 from mapi.util.decoder import *
 from mapi.util.logger import log
+from mapi.util.lru import LruCache
 from mapi.util.time import *
 
 RTF_MIN_SIZE = 16
-MSG_PROPERTY_SIZE = 16
+MSG_PROPERTY = struct.Struct("<HHI8s")
+MSG_PROPERTY_SIZE = MSG_PROPERTY.size
 
 STORE_OBJECT = 0x00000001
 ADDRESS_BOOK_object = 0x00000002
@@ -30,63 +40,169 @@ MSG_SUBSTG = "__substg1.0_"
 MSG_PROPS = "__properties_version1.0"
 MSG_EMBEDDED = "__substg1.0_3701000D"
 
+# decoded named property maps shared by messages with identical nameid streams
+NAMEID_CACHE_SIZE = 256
+NAMEID_CACHE = LruCache(NAMEID_CACHE_SIZE)
+
+# properties read by Msg.summary
+SUMMARY_PROPERTIES = (
+    ("class", (PidTagMessageClass, PtypString)),
+    ("subject", (PidTagSubject, PtypString)),
+    ("sender_name", (PidTagSenderName, PtypString)),
+    ("sender_email_address", (PidTagSenderEmailAddress, PtypString)),
+    ("sender_smtp_address", (PidTagSenderSmtpAddress, PtypString)),
+    ("to", (PidTagDisplayTo, PtypString)),
+    ("cc", (PidTagDisplayCc, PtypString)),
+    ("submit_time", (PidTagClientSubmitTime, PtypTime)),
+    ("delivery_time", (PidTagMessageDeliveryTime, PtypTime)),
+    ("receipt_time", (PidTagReceiptTime, PtypTime)),
+)
+
+# properties read by MsgAttachment.manifest
+MANIFEST_PROPERTIES = (
+    (PidTagAttachNumber, PtypInteger32),
+    (PidTagAttachLongFilename, PtypString),
+    (PidTagAttachFilename, PtypString),
+    (PidTagAttachMimeTag, PtypString),
+    (PidTagAttachMethod, PtypInteger32),
+    (PidTagAttachSize, PtypInteger32),
+    (PidTagAttachContentId, PtypString),
+)
+
+# body streams by kind, in the default order of preference
+BODY_PROPERTIES = {
+    "text": (PidTagBody, PtypString),
+    "html": (PidTagBodyHtml, PtypString),
+    "rtf": (PidTagRtfCompressed, PtypBinary),
+}
+BODY_PREFERENCES = tuple(BODY_PROPERTIES)
+
+# PidTagMessageCodepage applies to string properties, PidTagInternetCodepage to the bodies
+STRING_CODEPAGES = (PidTagMessageCodepage, PidTagInternetCodepage)
+BODY_CODEPAGES = (PidTagInternetCodepage, PidTagMessageCodepage)
+BODY_STRINGS = (PidTagBody, PidTagBodyHtml)
+
+# string properties hashed by MsgRoot.fingerprint
+FINGERPRINT_STRINGS = (
+    PidTagInternetMessageId,
+    PidTagSenderSmtpAddress,
+    PidTagSenderEmailAddress,
+    PidTagSenderName,
+    PidTagSubject,
+)
+
+# transport message header fields, folded lines included, up to the first empty line
+HEADER_FIELD = re.compile(r"^([!-9;-~]+)[ \t]*:[ \t]*(.*(?:\r?\n[ \t].*)*)", re.M)
+HEADER_FOLDING = re.compile(r"\r?\n(?=[ \t])")
+HEADERS_END = re.compile(r"\r?\n\r?\n")
+
+# properties copied by MsgRoot.snapshot
+SNAPSHOT_PROPERTIES = {
+    "message_id": (PidTagInternetMessageId, PtypString),
+    "message_class": (PidTagMessageClass, PtypString),
+    "subject": (PidTagSubject, PtypString),
+    "sender_name": (PidTagSenderName, PtypString),
+    "sender_email_address": (PidTagSenderEmailAddress, PtypString),
+    "sender_smtp_address": (PidTagSenderSmtpAddress, PtypString),
+    "to": (PidTagDisplayTo, PtypString),
+    "cc": (PidTagDisplayCc, PtypString),
+    "bcc": (PidTagDisplayBcc, PtypString),
+    "submit_time": (PidTagClientSubmitTime, PtypTime),
+    "delivery_time": (PidTagMessageDeliveryTime, PtypTime),
+    "receipt_time": (PidTagReceiptTime, PtypTime),
+}
+# fields read without touching attachment data, digests are computed only on request
+SNAPSHOT_DEFAULT_FIELDS = tuple(SNAPSHOT_PROPERTIES) + ("recipients", "attachments")
+SNAPSHOT_FIELDS = SNAPSHOT_DEFAULT_FIELDS + ("attachment_digests", "fingerprint")
+
+PS_MAPI = b"\x28\x03\x02\x00\x00\x00\x00\x00\xC0\x00\x00\x00\x00\x00\x00\x46"
+PS_PUBLIC_STRINGS = b"\x29\x03\x02\x00\x00\x00\x00\x00\xC0\x00\x00\x00\x00\x00\x00\x46"
+
 
 class MsgNamedProperties:
-    __slots__ = ['cfb', 'props', 'guids', 'entry', 'string']
+    __slots__ = ['cfb', 'props', 'guids', 'entry', 'string', 'names', 'ids']
 
     def __init__(self, cfb):
         self.cfb = cfb
         self.props = cfb.cfb_root.select_entry_by_name(MSG_NAMEID)[0]
 
-        name = MsgStorage.property_name(PidTagNameidStreamGuid, PtypBinary)
-        _data = cfb.read_stream(self.props, name)
-        self.guids = [_data[i:i + 16] for i in range(0, len(_data), 16)]
-
-        name = MsgStorage.property_name(PidTagNameidStreamEntry, PtypBinary)
-        _data = cfb.read_stream(self.props, name)
-        self.entry = [(uint32(_data[i:i + 4]), uint16(_data[i + 4:i + 6]), uint16(_data[i + 6:i + 8]))
-                      for i in range(0, len(_data), 8)]
-
-        name = MsgStorage.property_name(PidTagNameidStreamString, PtypBinary)
-        self.string = cfb.read_stream(self.props, name)
+        streams = [cfb.read_stream(self.props, MsgStorage.property_name(tag, PtypBinary)) or b""
+                   for tag in (PidTagNameidStreamGuid, PidTagNameidStreamEntry, PidTagNameidStreamString)]
+        key = self._digest(streams)
+        cached = NAMEID_CACHE.get(key)
+        if cached is None:
+            self._decode(*streams)
+            NAMEID_CACHE.put(key, (self.guids, self.entry, self.string, self.names, self.ids))
+        else:
+            self.guids, self.entry, self.string, self.names, self.ids = cached
+
+    def _decode(self, guids, entry, string):
+        self.guids = [guids[i:i + 16] for i in range(0, len(guids), 16)]
+        self.entry = [(uint32(entry[i:i + 4]), uint16(entry[i + 4:i + 6]), uint16(entry[i + 6:i + 8]))
+                      for i in range(0, len(entry), 8)]
+        self.string = string
+        self._index()
+
+    def _index(self):
+        # property id -> (name or LID, property set GUID, stream id)
+        self.names = dict()
+        # (property set GUID, name or LID) -> property id
+        self.ids = dict()
+        for index, ent in enumerate(self.entry):
+            _id = MIN_ID + index
+            if self._property_kind(ent) == 0:
+                name = self._name_identifier(ent)
+            else:
+                name = self._get_name_utf16(ent)
+            _guid = self._guid(self._guid_index(ent))
+            self.names[_id] = (name, _guid, self._stream_id(ent))
+            self.ids.setdefault((_guid, name), _id)
 
-        # print(self.property_name(0x8001), self.mapping(0x8001, 0x0102), self.property_guid(0x8001))
-        # print(self.property_name(0x800a), self.mapping(0x800a, 0x0102), self.property_guid(0x800a))
-        # print(self.property_name(0x800e), self.mapping(0x800e, 0x0102), self.property_guid(0x800e))
+    @staticmethod
+    def _digest(streams):
+        digest = hashlib.blake2b(digest_size=16)
+        for stream in streams:
+            digest.update(struct.pack("<I", len(stream)))
+            digest.update(stream)
+        return digest.digest()
 
     def mapping(self, _id, typ=PtypBinary):
-        ent = self._get_entry(_id)
-        return self._compute(ent, typ)
+        stream_id = self._get_entry(_id)[2]
+        return stream_id, "%s%04X%04X" % (MSG_SUBSTG, stream_id, typ)
 
     def property_name(self, _id):
-        ent = self._get_entry(_id)
-        if self._property_kind(ent) == 0:
-            name = self._name_identifier(ent)
-        else:
-            name = self._get_name_utf16(ent)
-        return name
+        return self._get_entry(_id)[0]
 
     def property_guid(self, _id):
-        ent = self._get_entry(_id)
-        return self._guid(self._guid_index(ent))
+        return self._get_entry(_id)[1]
+
+    def property_id(self, property_set, name):
+        if isinstance(property_set, (bytes, bytearray)):
+            property_set = guid(property_set)
+        return self.ids.get((property_set.upper(), name), None)
 
     def _get_entry(self, _id):
         assert (MIN_ID <= _id <= MAX_ID)
-        index = _id - MIN_ID
-        assert (0 <= index < len(self.entry))
-        return self.entry[index]
+        assert (_id in self.names)
+        return self.names[_id]
 
-    def _compute(self, ent, typ):
+    def _stream_id(self, ent):
         if self._property_kind(ent) == 0:
             name = self._name_identifier(ent)
-            stream_id = BASE_STREAM_ID + (name ^ (self._guid_index(ent) << 1)) % 0x1F
+            return BASE_STREAM_ID + (name ^ (self._guid_index(ent) << 1)) % 0x1F
         else:
             name = crc32(self._get_name(ent))
-            stream_id = BASE_STREAM_ID + (name ^ ((self._guid_index(ent) << 1) | 1)) % 0x1F
-        return stream_id, "%s%04X%04X" % (MSG_SUBSTG, stream_id, typ)
+            return BASE_STREAM_ID + (name ^ ((self._guid_index(ent) << 1) | 1)) % 0x1F
 
     def _guid(self, i):
-        return guid(self.guids[i])
+        # GUID index 1 and 2 are reserved for PS_MAPI and PS_PUBLIC_STRINGS
+        if i == 1:
+            return guid(PS_MAPI)
+        if i == 2:
+            return guid(PS_PUBLIC_STRINGS)
+        if 3 <= i < len(self.guids) + 3:
+            return guid(self.guids[i - 3])
+        return None
 
     def _get_name(self, ent):
         offset = self._string_offset(ent)
@@ -122,7 +238,7 @@ class MsgNamedProperties:
 
 
 class MsgProperties:
-    __slots__ = ['name', 'cfb', 'header', 'properties']
+    __slots__ = ['name', 'cfb', 'header', 'properties', 'by_tag_type', 'by_tag', 'cache']
 
     def __init__(self, cfb, storage, name):
         self.name = name
@@ -130,12 +246,17 @@ class MsgProperties:
         props = self.cfb.read_stream(storage, MSG_PROPS)
         assert (props is not None)
         self._header(name, props)
-        properties = props[len(self.header):]
-        properties_list = [properties[i:i + MSG_PROPERTY_SIZE]
-                           for i in range(0, len(properties), MSG_PROPERTY_SIZE)]
-        self.properties = [self._property(prop) for prop in properties_list]
+        self.properties = self._properties(props, len(self.header))
+        self._index()
         self.debug(0)
 
+    def _index(self):
+        # first record wins, as with the former linear scans
+        self.by_tag_type, self.by_tag, self.cache = dict(), dict(), dict()
+        for prop in self.properties:
+            self.by_tag_type.setdefault((prop[1], prop[0]), prop)
+            self.by_tag.setdefault(prop[1], prop)
+
     def debug(self, b):
         if b:
             print(self.name)
@@ -167,48 +288,72 @@ class MsgProperties:
         assert (len(self.header) >= 24)
         return uint32(self.header[20:24])
 
+    def find(self, tag, typ=None):
+        if typ is None:
+            return self.by_tag.get(tag, None)
+        return self.by_tag_type.get((tag, typ), None)
+
     def get_property(self, tag, typ):
-        for prop in self.properties:
-            if prop[0] == typ and prop[1] == tag:
-                return prop[2], int32(prop[3][0:4]), uint32(prop[3][4:8])
-        return None, None, None
+        return self._cached(tag, typ, self._value, (None, None, None))
 
     def get_property_bool(self, tag, typ):
-        for prop in self.properties:
-            if prop[0] == typ and prop[1] == tag:
-                return prop[2], uint8(prop[3][0:1])
-        return None, None
+        return self._cached(tag, typ, self._value_bool, (None, None))
 
     def get_property_int64(self, tag, typ):
-        for prop in self.properties:
-            if prop[0] == typ and prop[1] == tag:
-                return prop[2], int64(prop[3][0:8])
-        return None, None
+        return self._cached(tag, typ, self._value_int64, (None, None))
 
     def get_property_float(self, tag, typ):
-        for prop in self.properties:
-            if prop[0] == typ and prop[1] == tag:
-                return prop[2], float(prop[3][0:4]), uint32(prop[3][4:8])
-        return None, None, None
+        return self._cached(tag, typ, self._value_float, (None, None, None))
 
     def get_property_long(self, tag, typ):
-        for prop in self.properties:
-            if prop[0] == typ and prop[1] == tag:
-                return prop[2], uint64(prop[3][0:8])
-        return None, None, None
+        return self._cached(tag, typ, self._value_long, (None, None, None))
+
+    def _cached(self, tag, typ, decoder, default):
+        key = (decoder, tag, typ)
+        value = self.cache.get(key, None)
+        if value is None:
+            prop = self.by_tag_type.get((tag, typ), None)
+            value = default if prop is None else decoder(prop)
+            self.cache[key] = value
+        return value
+
+    @staticmethod
+    def _value(prop):
+        return prop[2], int32(prop[3][0:4]), uint32(prop[3][4:8])
+
+    @staticmethod
+    def _value_bool(prop):
+        return prop[2], uint8(prop[3][0:1])
+
+    @staticmethod
+    def _value_int64(prop):
+        return prop[2], int64(prop[3][0:8])
+
+    @staticmethod
+    def _value_float(prop):
+        return prop[2], float(prop[3][0:4]), uint32(prop[3][4:8])
+
+    @staticmethod
+    def _value_long(prop):
+        return prop[2], uint64(prop[3][0:8])
 
     @staticmethod
-    def _property(prop):
+    def _properties(props, offset):
         # property_type, property_tag, flags, value
-        return uint16(prop[0:2]), uint16(prop[2:4]), uint32(prop[4:8]), prop[8:]
+        size = (len(props) - offset) // MSG_PROPERTY_SIZE * MSG_PROPERTY_SIZE
+        view = memoryview(props)[offset:offset + size]
+        return list(MSG_PROPERTY.iter_unpack(view))
 
 
 class MsgStorage:
-    __slots__ = ['cfb', 'data', 'props']
+    __slots__ = ['cfb', 'data', 'props', 'parent', '_codec', '_body_codec']
 
-    def __init__(self, cfb, data):
+    def __init__(self, cfb, data, parent=None):
         self.cfb = cfb
         self.data = data
+        self.parent = parent
+        self._codec = None
+        self._body_codec = None
         name = data.directory_entry_name()
         if name.startswith(MSG_NAMEID):
             self.props = None
@@ -218,6 +363,90 @@ class MsgStorage:
     def stream(self, tag, typ):
         return self._read_stream(self.data, tag, typ)
 
+    def string(self, tag):
+        # PtypString, or PtypString8 decoded with the message or body code page
+        _data = self.stream(tag, PtypString)
+        if _data is None:
+            return self._decoder(STREAM_DECODERS, PtypString8, tag)(self.stream(tag, PtypString8))
+        else:
+            return utf16(_data)
+
+    def string8(self, data):
+        return None if data is None else string8(data, self.codec())
+
+    def body_string8(self, data):
+        return None if data is None else string8(data, self.body_codec())
+
+    def codec(self):
+        # code page of PtypString8 properties
+        if self._codec is None:
+            self._codec = self._resolve_codec(STRING_CODEPAGES, MsgStorage.codec)
+        return self._codec
+
+    def body_codec(self):
+        # code page of PtypString8 bodies
+        if self._body_codec is None:
+            self._body_codec = self._resolve_codec(BODY_CODEPAGES, MsgStorage.body_codec)
+        return self._body_codec
+
+    def _resolve_codec(self, tags, inherited):
+        if self.props is not None:
+            for tag in tags:
+                codepage = self.props.get_property(tag, PtypInteger32)[1]
+                codec = None if not codepage else codepage_codec(codepage)
+                if codec is not None:
+                    return codec
+        return DEFAULT_CODEC if self.parent is None else inherited(self.parent)
+
+    def value(self, tag, typ):
+        return self.fetch([(tag, typ)])[(tag, typ)]
+
+    def fetch(self, properties):
+        values, streams = dict(), dict()
+        for tag, typ in properties:
+            values[(tag, typ)] = None
+            if typ in FIXED_DECODERS:
+                prop = None if self.props is None else self.props.find(tag, typ)
+                if prop is not None:
+                    values[(tag, typ)] = FIXED_DECODERS[typ](prop[3])
+            elif typ == PtypObject:
+                values[(tag, typ)] = self.find(tag, typ)
+            else:
+                streams[(tag, typ)] = self.find(tag, typ)
+
+        multiple = dict()
+        for key, _data in zip(list(streams), self.cfb.read_streams(list(streams.values()))):
+            if _data is None:
+                continue
+            if key[1] in MULTIPLE_DECODERS:
+                multiple[key] = self._find_elements(key[0], key[1], len(_data))
+            else:
+                decoder = self._decoder(STREAM_DECODERS, key[1], key[0])
+                values[key] = _data if decoder is None else decoder(_data)
+
+        # PtypString properties stored as PtypString8
+        keys = [key for key in streams if key[1] == PtypString and values[key] is None]
+        for key, _data in zip(keys, self.cfb.read_streams([self.find(key[0], PtypString8) for key in keys])):
+            values[key] = self._decoder(STREAM_DECODERS, PtypString8, key[0])(_data)
+
+        # element streams of multi-valued variable length properties
+        elements = iter(self.cfb.read_streams([entry for entries in multiple.values() for entry in entries]))
+        for key, entries in multiple.items():
+            chunks = [next(elements) or b"" for _ in entries]
+            offsets = multiple_offsets(len(chunk) for chunk in chunks)
+            values[key] = MsgValues(b"".join(chunks), offsets, self._decoder(MULTIPLE_DECODERS, key[1]))
+        return values
+
+    def _decoder(self, decoders, typ, tag=None):
+        if typ in (PtypString8, PtypMultipleString8):
+            return self.body_string8 if tag in BODY_STRINGS else self.string8
+        return decoders.get(typ, None)
+
+    def _find_elements(self, tag, typ, size):
+        prop_name = self.property_name(tag, typ)
+        return [self.cfb.find_stream(self.data, "%s-%08X" % (prop_name, i))
+                for i in range(0, size // MULTIPLE_LENGTH_SIZE[typ])]
+
     def find(self, tag, typ):
         return self._find_stream(self.data, tag, typ)
 
@@ -230,8 +459,7 @@ class MsgStorage:
         return self.cfb.find_stream(root, prop_name)
 
     def get_display_name(self):
-        _data = self.stream(PidTagDisplayName, PtypString)
-        return utf16(_data)
+        return self.string(PidTagDisplayName)
 
     @staticmethod
     def property_name(tag, typ):
@@ -240,65 +468,116 @@ class MsgStorage:
 
 
 class MsgRoot(MsgStorage):
+    __slots__ = ['bodies', '_content_ids', '_headers']
+
+    def __init__(self, cfb, root, parent=None):
+        super().__init__(cfb, root, parent)
+        self.bodies = dict()
+        self._content_ids = None
+        self._headers = None
 
-    def __init__(self, cfb, root):
-        super().__init__(cfb, root)
+    def transport_headers(self):
+        if self._headers is None:
+            self._headers = MsgHeaders(self.string(PidTagTransportMessageHeaders) or "")
+        return self._headers
+
+    def header(self, name, default=None):
+        return self.transport_headers().get(name, default)
+
+    def content_ids(self):
+        if self._content_ids is None:
+            self._content_ids = MsgContentIds(self.get_attachments())
+        return self._content_ids
 
     def message_class(self):
-        _data = self.stream(PidTagMessageClass, PtypString)
-        return utf16(_data)
+        return self.string(PidTagMessageClass)
 
     def message_id(self):
-        _data = self.stream(PidTagInternetMessageId, PtypString)
-        return utf16(_data)
+        return self.string(PidTagInternetMessageId)
 
     def display_to(self):
-        _data = self.stream(PidTagDisplayTo, PtypString)
-        return utf16(_data)
+        return self.string(PidTagDisplayTo)
 
     def display_cc(self):
-        _data = self.stream(PidTagDisplayCc, PtypString)
-        return utf16(_data)
+        return self.string(PidTagDisplayCc)
 
     def display_bcc(self):
-        _data = self.stream(PidTagDisplayBcc, PtypString)
-        return utf16(_data)
+        return self.string(PidTagDisplayBcc)
 
     def sender_name(self):
-        _data = self.stream(PidTagSenderName, PtypString)
-        return utf16(_data)
+        return self.string(PidTagSenderName)
 
     def sender_email_address(self):
-        _data = self.stream(PidTagSenderEmailAddress, PtypString)
-        return utf16(_data)
+        return self.string(PidTagSenderEmailAddress)
 
     def sender_smtp_address(self):
-        _data = self.stream(PidTagSenderSmtpAddress, PtypString)
-        return utf16(_data)
+        return self.string(PidTagSenderSmtpAddress)
 
     def subject(self):
-        _data = self.stream(PidTagSubject, PtypString)
-        return utf16(_data)
+        return self.string(PidTagSubject)
 
     def body_content_id(self):
-        _data = self.stream(PidTagBodyContentId, PtypString)
-        return utf16(_data)
+        return self.string(PidTagBodyContentId)
 
     def body_text(self):
-        _data = self.stream(PidTagBody, PtypString)
-        return utf16(_data)
+        return self.string(PidTagBody)
 
     def body_html(self):
-        _data = self.stream(PidTagBodyHtml, PtypString)
+        _data = self.string(PidTagBodyHtml)
         if _data is None:
             return self.rtf_as_html()
         else:
-            return utf16(_data)
+            return _data
 
     def body_rtf(self):
+        return self._body("rtf", self._body_rtf)
+
+    def iter_body_rtf(self):
+        # decompressed RTF body in chunks, without reading the compressed stream whole
+        entry = self.find(PidTagRtfCompressed, PtypBinary)
+        if entry is None or entry.stream_size() < RTF_MIN_SIZE:
+            return iter(())
+        return decompress_iter(io.BufferedReader(CfbStreamReader(self.cfb, entry)))
+
+    def body_sizes(self):
+        # stream sizes from the directory entries, no body is read
+        sizes = dict()
+        for kind, (tag, typ) in BODY_PROPERTIES.items():
+            entry = self.find(tag, typ)
+            if entry is None and typ == PtypString:
+                entry = self.find(tag, PtypString8)
+            if entry is not None and entry.stream_size() > 0:
+                sizes[kind] = entry.stream_size()
+        return sizes
+
+    def best_body(self, preferences=BODY_PREFERENCES):
+        sizes = self.body_sizes()
+        for kind in preferences:
+            if kind not in sizes:
+                continue
+            if kind == "text":
+                body = self.body_text()
+            elif kind == "html":
+                body = self.string(PidTagBodyHtml)
+            else:
+                body = self.body_rtf()
+            # a stream that fails to decode falls through to the next preference
+            if body is not None:
+                return kind, body
+        return None, None
+
+    def _body_rtf(self):
         _data = self.stream(PidTagRtfCompressed, PtypBinary)
         return self._decompress(_data)
 
+    def _body(self, key, reader):
+        if key not in self.bodies:
+            self.bodies[key] = reader()
+        return self.bodies[key]
+
+    def clear_cache(self):
+        self.bodies.clear()
+
     def rtf_in_sync(self):
         return self.props.get_property_bool(PidTagRtfInSync, PtypBoolean)[1]
 
@@ -323,7 +602,109 @@ class MsgRoot(MsgStorage):
         time = self.props.get_property_int64(PidTagReceiptTime, PtypTime)
         return filetime2datetime(time[1])
 
+    def fingerprint(self, attachment_digests=None):
+        # hash of raw property streams, nothing is decoded, `attachment_digests`
+        # reuses digests already computed by _attachment_digest
+        digest = hashlib.sha256()
+        for tag in FINGERPRINT_STRINGS:
+            entry = self.find(tag, PtypString)
+            self._digest_stream(digest, tag, entry or self.find(tag, PtypString8))
+        prop = self.props.find(PidTagClientSubmitTime, PtypTime)
+        digest.update(b"" if prop is None else prop[3])
+        sizes = self.body_sizes()
+        kind = next((kind for kind in BODY_PREFERENCES if kind in sizes), None)
+        if kind is not None:
+            tag, typ = BODY_PROPERTIES[kind]
+            entry = self.find(tag, typ)
+            self._digest_stream(digest, tag, entry or self.find(tag, PtypString8))
+        for i, attachment in enumerate(self.get_attachments()):
+            embedded = attachment.get_embedded_attachment()
+            if embedded is None:
+                data = self._attachment_digest(attachment) if attachment_digests is None else attachment_digests[i]
+                digest.update(hashlib.sha256().digest() if data is None else data)
+            else:
+                digest.update(bytes.fromhex(embedded.fingerprint()))
+        return digest.hexdigest()
+
+    def _digest_stream(self, digest, tag, entry):
+        size = 0 if entry is None else entry.stream_size()
+        digest.update(struct.pack("<IQ", tag, size))
+        for chunk in self.cfb.iter_stream(entry):
+            digest.update(chunk)
+
+    def snapshot(self, fields=None):
+        # detached copy of the selected fields, see MsgSnapshot
+        fields = SNAPSHOT_DEFAULT_FIELDS if fields is None else fields
+        values = self.fetch([SNAPSHOT_PROPERTIES[name] for name in fields if name in SNAPSHOT_PROPERTIES])
+        snapshot = dict()
+        digests = None
+        for name in fields:
+            if name in SNAPSHOT_PROPERTIES:
+                value = values[SNAPSHOT_PROPERTIES[name]]
+                snapshot[name] = sys.intern(value) if isinstance(value, str) else value
+            elif name == "recipients":
+                snapshot[name] = tuple((self._intern(recipient.get_recipient_display_name()),
+                                        self._intern(recipient.get_smtp_address()))
+                                       for recipient in self.get_recipients())
+            elif name == "attachments":
+                snapshot[name] = tuple(self._attachment_reference(attachment)
+                                       for attachment in self.get_attachments())
+            elif name in ("attachment_digests", "fingerprint"):
+                # attachment data is read once when both are requested
+                if digests is None:
+                    digests = tuple(self._attachment_digest(attachment) for attachment in self.get_attachments())
+                snapshot[name] = digests if name == "attachment_digests" else self.fingerprint(digests)
+            else:
+                raise KeyError("Unknown snapshot field %s" % name)
+        return MsgSnapshot(**snapshot)
+
+    def _attachment_reference(self, attachment):
+        # (file name, mime, size, file extents of the attachment data)
+        data = attachment.find(PidTagAttachDataBinary, PtypBinary)
+        size = attachment.get_attachment_size() if data is None else data.stream_size()
+        extents = () if data is None else tuple(self.cfb.file_extents(data))
+        return (self._intern(attachment.get_attachment_file_name()),
+                self._intern(attachment.get_attachment_mime()), size, extents)
+
+    def _attachment_digest(self, attachment):
+        data = attachment.find(PidTagAttachDataBinary, PtypBinary)
+        if data is None:
+            return None
+        digest = hashlib.sha256()
+        for chunk in self.cfb.iter_stream(data):
+            digest.update(chunk)
+        return digest.digest()
+
+    @staticmethod
+    def _intern(value):
+        return None if value is None else sys.intern(value)
+
+    def iter_embedded(self, max_depth=None, max_bytes=None):
+        # depth first over embedded messages, each one is built only when reached
+        if max_depth is not None and max_depth <= 0:
+            return
+        stack = [((), enumerate(self.get_attachments()))]
+        while stack:
+            path, attachments = stack[-1]
+            i, attachment = next(attachments, (None, None))
+            if attachment is None:
+                stack.pop()
+                continue
+            if not attachment.is_attachment_object():
+                continue
+            if max_bytes is not None:
+                max_bytes -= attachment.get_attachment_size() or 0
+                if max_bytes < 0:
+                    return
+            embedded = attachment.get_embedded_attachment()
+            yield path + (i,), embedded
+            if max_depth is None or len(path) + 1 < max_depth:
+                stack.append((path + (i,), enumerate(embedded.get_attachments())))
+
     def rtf_as_html(self):
+        return self._body("html", self._rtf_as_html)
+
+    def _rtf_as_html(self):
         data = self.body_rtf()
         if data is None:
             return None
@@ -331,6 +712,9 @@ class MsgRoot(MsgStorage):
             return RtfParser(data.decode("utf-8")).decode_html()
 
     def rtf_as_text(self):
+        return self._body("text", self._rtf_as_text)
+
+    def _rtf_as_text(self):
         data = self.body_rtf()
         if data is None:
             return None
@@ -348,23 +732,35 @@ class MsgRoot(MsgStorage):
 
 
 class MsgEmbedded(MsgRoot):
-    __slots__ = ['attachments', 'recipients']
+    __slots__ = ['_attachments', '_recipients']
 
-    def __init__(self, cfb, root):
-        super().__init__(cfb, root)
-        self.attachments, self.recipients = self.initialize()
+    def __init__(self, cfb, root, parent=None):
+        super().__init__(cfb, root, parent)
+        self._attachments = None
+        self._recipients = None
+
+    @property
+    def attachments(self):
+        if self._attachments is None:
+            self._attachments = MsgAttachments(self.cfb, self._children(MSG_ATTACH), self.num_attachments(), self)
+        return self._attachments
+
+    @property
+    def recipients(self):
+        if self._recipients is None:
+            self._recipients = MsgRecipients(self.cfb, self._children(MSG_RECIP), self.num_recipients(), self)
+        return self._recipients
 
     def initialize(self):
-        attachments, recipients = [], []
+        return self.attachments, self.recipients
+
+    def _children(self, prefix):
+        entries = []
         for child in self.data.children:
             entry = self.cfb.cfb_root.entry(child)
-            name = entry.directory_entry_name()
-            if name.startswith(MSG_ATTACH):
-                attachments.append(entry)
-            elif name.startswith(MSG_RECIP):
-                recipients.append(entry)
-
-        return MsgAttachments(self.cfb, attachments), MsgRecipients(self.cfb, recipients)
+            if entry.directory_entry_name().startswith(prefix):
+                entries.append(entry)
+        return entries
 
     def get_root(self):
         return self
@@ -378,41 +774,68 @@ class MsgEmbedded(MsgRoot):
 
 class MsgAttachment(MsgStorage):
 
-    def __init__(self, cfb, attachment):
-        super().__init__(cfb, attachment)
+    def __init__(self, cfb, attachment, parent=None):
+        super().__init__(cfb, attachment, parent)
 
     def get_attachment(self):
         return self.stream(PidTagAttachDataBinary, PtypBinary)
 
+    def open(self):
+        data = self.find(PidTagAttachDataBinary, PtypBinary)
+        if data is None:
+            return None
+        else:
+            return io.BufferedReader(CfbStreamReader(self.cfb, data))
+
+    def save_to(self, target):
+        data = self.find(PidTagAttachDataBinary, PtypBinary)
+        if data is None:
+            return None
+        if not hasattr(target, "write"):
+            with open(target, "wb") as fp:
+                return self._copy(data, fp)
+        return self._copy(data, target)
+
+    def export(self, store):
+        # content addressed export, returns the SHA-256 hex digest of the attachment data
+        data = self.find(PidTagAttachDataBinary, PtypBinary)
+        if data is None or data.stream_size() == 0:
+            return None
+        with self.open() as reader:
+            head = reader.read(store.head_size)
+        return store.add(data.stream_size(), head, lambda: self.cfb.iter_stream(data))
+
+    def _copy(self, data, fp):
+        written = 0
+        for chunk in self.cfb.iter_stream(data):
+            written += fp.write(chunk)
+        return written
+
     def get_embedded_attachment(self):
         data = self.find(PidTagAttachDataObject, PtypObject)
         if data is None:
             return None
         else:
-            return MsgEmbedded(self.cfb, data)
+            return MsgEmbedded(self.cfb, data, self)
 
     def is_attachment_object(self):
         _data = self.find(PidTagAttachDataObject, PtypObject)
         return False if _data is None else True
 
     def get_attachment_file_name(self):
-        _data = self.stream(PidTagAttachLongFilename, PtypString)
-        return utf16(_data)
+        return self.string(PidTagAttachLongFilename)
 
     def get_attachment_mime(self):
-        _data = self.stream(PidTagAttachMimeTag, PtypString)
-        return utf16(_data)
+        return self.string(PidTagAttachMimeTag)
 
     def get_attachment_size(self):
-        _data = self.stream(PidTagAttachSize, PtypInteger32)
-        return int32(_data)
+        return self.props.get_property(PidTagAttachSize, PtypInteger32)[1]
 
     def get_attachment_number(self):
         return self.props.get_property(PidTagAttachNumber, PtypInteger32)[1]
 
     def get_attachment_content_id(self):
-        _data = self.stream(PidTagAttachContentId, PtypString)
-        return utf16(_data)
+        return self.string(PidTagAttachContentId)
 
     def get_object_type(self):
         return self.props.get_property(PidTagObjectType, PtypInteger32)[1]
@@ -423,66 +846,250 @@ class MsgAttachment(MsgStorage):
     def is_attachment_msg(self):
         return "message/rfc822" == self.get_attachment_mime()
 
+    def manifest(self):
+        # directory entries and small streams only, attachment data is never read
+        values = self.fetch(MANIFEST_PROPERTIES)
+        data = self.find(PidTagAttachDataBinary, PtypBinary)
+        name = values[(PidTagAttachLongFilename, PtypString)] or values[(PidTagAttachFilename, PtypString)]
+        size = values[(PidTagAttachSize, PtypInteger32)] if data is None else data.stream_size()
+        return {
+            "id": values[(PidTagAttachNumber, PtypInteger32)],
+            "name": name,
+            "mime": values[(PidTagAttachMimeTag, PtypString)],
+            "method": values[(PidTagAttachMethod, PtypInteger32)],
+            "size": size,
+            "content_id": values[(PidTagAttachContentId, PtypString)],
+            "embedded": self.is_attachment_object(),
+        }
+
+
+class MsgItems:
+    """
+    Recipient or attachment storages of a message, each item object is built on first access
+    """
+    __slots__ = ['cfb', 'entries', 'count', 'items', 'parent']
+
+    item_class = None
+    prefix = None
+
+    def __init__(self, cfb, entries=None, count=None, parent=None):
+        self.cfb = cfb
+        self.entries = entries
+        self.count = count
+        self.parent = parent
+        self.items = dict()
+
+    def __len__(self):
+        return len(self._entries()) if self.count is None else self.count
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        assert 0 <= item < len(self)
+        value = self.items.get(item, None)
+        if value is None:
+            value = self.item_class(self.cfb, self._entries()[item], self.parent)
+            self.items[item] = value
+        return value
 
-class MsgAttachments:
-    __slots__ = ['attachments']
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self[i]
 
-    def __init__(self, cfb, attachments=None):
-        if attachments is None:
-            attachments = cfb.cfb_root.select_entry_by_name(MSG_ATTACH)
-        self.attachments = [MsgAttachment(cfb, attachment) for attachment in attachments]
+    def _entries(self):
+        if self.entries is None:
+            self.entries = self.cfb.cfb_root.select_entry_by_name(self.prefix)
+        return self.entries
+
+
+class MsgAttachments(MsgItems):
+    __slots__ = []
+
+    item_class = MsgAttachment
+    prefix = MSG_ATTACH
+
+    def manifest(self):
+        return [attachment.manifest() for attachment in self]
+
+    def export(self, store):
+        return [attachment.export(store) for attachment in self]
+
+
+class MsgContentIds(Mapping):
+    """
+    Content id to attachment mapping of a message, for cid: references in HTML bodies
+    """
+    __slots__ = ['attachments', 'index']
+
+    def __init__(self, attachments):
+        self.attachments = attachments
+        self.index = None
+
+    def __getitem__(self, content_id):
+        return self._index()[self.normalize(content_id)]
 
     def __len__(self):
-        return len(self.attachments)
+        return len(self._index())
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def _index(self):
+        # built on first use from the content id streams, attachment data is not read
+        if self.index is None:
+            index = dict()
+            for attachment in self.attachments:
+                content_id = attachment.get_attachment_content_id()
+                if content_id:
+                    index.setdefault(self.normalize(content_id), attachment)
+            self.index = index
+        return self.index
 
-    def __getitem__(self, item):
-        assert 0 <= item < len(self.attachments)
-        return self.attachments[item]
+    @staticmethod
+    def normalize(content_id):
+        content_id = content_id.strip().rstrip("\x00")
+        if content_id[0:4].lower() == "cid:":
+            content_id = content_id[4:]
+        return content_id.strip("<>")
+
+
+class MsgHeaders(Mapping):
+    """
+    Case insensitive index of transport message header offsets, values are sliced on access
+    """
+    __slots__ = ['text', 'index']
+
+    def __init__(self, text):
+        self.text = text
+        self.index = None
+
+    def __getitem__(self, name):
+        spans = self._index()[name.lower()]
+        return self._value(spans[0])
+
+    def __len__(self):
+        return len(self._index())
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def get_all(self, name):
+        return [self._value(span) for span in self._index().get(name.lower(), [])]
+
+    def _index(self):
+        if self.index is None:
+            index = dict()
+            end = HEADERS_END.search(self.text)
+            for match in HEADER_FIELD.finditer(self.text, 0, len(self.text) if end is None else end.start()):
+                index.setdefault(match.group(1).lower(), []).append(match.span(2))
+            self.index = index
+        return self.index
+
+    def _value(self, span):
+        return HEADER_FOLDING.sub("", self.text[span[0]:span[1]]).strip()
+
+
+class MsgSnapshot:
+    """
+    Immutable, picklable copy of message fields, detached from the file
+    """
+    __slots__ = SNAPSHOT_FIELDS
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.pop(name, None))
+        assert (len(values) == 0)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MsgSnapshot is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("MsgSnapshot is immutable")
+
+    def __reduce__(self):
+        return _snapshot, (self._values(),)
+
+    def __eq__(self, other):
+        return isinstance(other, MsgSnapshot) and self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return "MsgSnapshot(%s)" % ", ".join("%s=%r" % (name, getattr(self, name))
+                                             for name in self.__slots__ if getattr(self, name) is not None)
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+def _snapshot(values):
+    return MsgSnapshot(**dict(zip(MsgSnapshot.__slots__, values)))
 
 
 class MsgRecipient(MsgStorage):
 
-    def __init__(self, cfb, recipient):
-        super().__init__(cfb, recipient)
+    def __init__(self, cfb, recipient, parent=None):
+        super().__init__(cfb, recipient, parent)
 
     def get_recipient_display_name(self):
-        _data = self.stream(PidTagRecipientDisplayName, PtypString)
-        return utf16(_data)
+        return self.string(PidTagRecipientDisplayName)
 
     def get_smtp_address(self):
-        _data = self.stream(PidTagSmtpAddress, PtypString)
-        return utf16(_data)
+        return self.string(PidTagSmtpAddress)
 
     def get_email_address(self):
-        _data = self.stream(PidTagEmailAddress, PtypString)
-        return utf16(_data)
-
-
-class MsgRecipients:
-    __slots__ = ['recipients']
+        return self.string(PidTagEmailAddress)
 
-    def __init__(self, cfb, recipients=None):
-        if recipients is None:
-            recipients = cfb.cfb_root.select_entry_by_name(MSG_RECIP)
-        self.recipients = [MsgRecipient(cfb, recipient) for recipient in recipients]
 
-    def __len__(self):
-        return len(self.recipients)
+class MsgRecipients(MsgItems):
+    __slots__ = []
 
-    def __getitem__(self, item):
-        assert 0 <= item < len(self.recipients)
-        return self.recipients[item]
+    item_class = MsgRecipient
+    prefix = MSG_RECIP
 
 
 class Msg(MsgRoot):
-    __slots__ = ['named_props', 'recipients', 'attachments']
+    __slots__ = ['_named_props', '_recipients', '_attachments']
 
-    def __init__(self, fp):
-        cfb = Cfb(fp)
+    def __init__(self, fp, index_cache=None, key=None):
+        if index_cache is None:
+            cfb = Cfb(fp)
+        else:
+            cfb = index_cache.open(fp, key, (MSG_PROPS,))
         super().__init__(cfb, cfb.cfb_root.root())
-        self.named_props = MsgNamedProperties(cfb)
-        self.recipients = MsgRecipients(cfb)
-        self.attachments = MsgAttachments(cfb)
+        self._named_props = None
+        self._recipients = None
+        self._attachments = None
+
+    @property
+    def named_props(self):
+        if self._named_props is None:
+            self._named_props = MsgNamedProperties(self.cfb)
+        return self._named_props
+
+    @property
+    def recipients(self):
+        if self._recipients is None:
+            self._recipients = MsgRecipients(self.cfb, count=self.num_recipients(), parent=self)
+        return self._recipients
+
+    @property
+    def attachments(self):
+        if self._attachments is None:
+            self._attachments = MsgAttachments(self.cfb, count=self.num_attachments(), parent=self)
+        return self._attachments
+
+    @staticmethod
+    def summary(fp):
+        # reads only the root properties and a few root streams
+        cfb = Cfb(fp)
+        root = MsgRoot(cfb, cfb.cfb_root.root())
+        values = root.fetch([key for _, key in SUMMARY_PROPERTIES])
+        summary = dict((name, values[key]) for name, key in SUMMARY_PROPERTIES)
+        summary["recipients"] = root.num_recipients()
+        summary["attachments"] = root.num_attachments()
+        return summary
 
     def get_root(self):
         return self
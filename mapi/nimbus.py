@@ -1,3 +1,6 @@
+MAX_EMBEDDED_DEPTH = 16
+
+
 def body_data(mapi):
     body = dict()
     body["text"] = mapi.body_text()
@@ -32,7 +35,7 @@ def recipients_data(mapi):
     return recipients_map
 
 
-def attachments_data(mapi):
+def attachments_data(mapi, depth=MAX_EMBEDDED_DEPTH):
     attachments = mapi.get_attachments()
     count = mapi.num_attachments()
     attachments_map = dict()
@@ -49,10 +52,10 @@ def attachments_data(mapi):
         attachment_map["method"] = attachment.get_attach_method()
         attachment_map["file_name"] = attachment.get_attachment_file_name()
         attachment_map["size"] = attachment.get_attachment_size()
-        if attachment.is_attachment_msg():
+        if depth > 0 and attachment.is_attachment_msg():
             emb = attachment.get_embedded_attachment()
             if emb is not None:
-                attachment_map["embedded"] = json_msg(emb)
+                attachment_map["embedded"] = json_msg(emb, depth - 1)
         attachments_list.append(attachment_map)
     attachments_map["attachments"] = attachments_list
     return attachments_map
@@ -69,7 +72,7 @@ def text_filter(data):
         return data.replace("\u0000", "")
 
 
-def json_msg(mapi):
+def json_msg(mapi, depth=MAX_EMBEDDED_DEPTH):
     data = dict()
     data["id"] = mapi.message_id()
     data["class"] = mapi.message_class()
@@ -83,5 +86,5 @@ def json_msg(mapi):
     data["subject"] = mapi.subject()
     data["body"] = body_data(mapi)
     data["recipients"] = recipients_data(mapi)
-    data["attachments"] = attachments_data(mapi)
+    data["attachments"] = attachments_data(mapi, depth)
     return data
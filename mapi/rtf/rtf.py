@@ -5,15 +5,12 @@ Based on Rich Text Format (RTF) Compression Algorithm
 https://msdn.microsoft.com/en-us/library/cc463890(v=exchg.80).aspx
 """
 
-import sys
-from io import BytesIO
+import struct
+from array import array
 
 from mapi.util.crc32 import crc32
-from mapi.util.decoder import *
 
-__all__ = ['decompress']
-
-PY3 = sys.version_info[0] == 3
+__all__ = ['compress', 'decompress', 'decompress_iter']
 
 INIT_DICT = (
     b'{\\rtf1\\ansi\\mac\\deff0\\deftab720{\\fonttbl;}{\\f0\\fnil \\froman \\'
@@ -24,72 +21,257 @@ INIT_DICT = (
 
 INIT_DICT_SIZE = 207
 MAX_DICT_SIZE = 4096
+DICT_MASK = MAX_DICT_SIZE - 1
+
+# compressed size, raw size, compression type, CRC
+HEADER = struct.Struct("<II4sI")
 
 COMPRESSED = b'LZFu'
 UNCOMPRESSED = b'MELA'
 
 
+# control byte and eight references
+GROUP_SIZE = 17
+
+# match lengths of a reference, and candidates tried per position when compressing
+MIN_MATCH = 3
+MAX_MATCH = 17
+MAX_CHAIN = 64
+
+
 def decompress(data):
     """
     Decompress `data` using RTF compression algorithm
     """
-    # set init dict
-    if len(data) < 16:
+    if len(data) < HEADER.size:
         raise Exception('Data must be at least 16 bytes long')
-    init_dict = list(INIT_DICT + b' ' * (MAX_DICT_SIZE - INIT_DICT_SIZE))
-    write_offset = INIT_DICT_SIZE
-    output_buffer = []
-    # make stream
-    in_stream = BytesIO(data)
+    comp_size, raw_size, comp_type, crc_value = HEADER.unpack_from(data, 0)
 
-    # read compressed RTF header
-    comp_size = uint32(in_stream.read(4))
-    raw_size = uint32(in_stream.read(4))
-    comp_type = in_stream.read(4)
-    crc_value = uint32(in_stream.read(4))
-
-    # get only data
-    contents = BytesIO(in_stream.read(comp_size - 12))
+    # get only data, the compressed size counts the last 12 bytes of the header
+    contents = memoryview(data)[HEADER.size:comp_size + 4]
 
     if comp_type == COMPRESSED:
         # check CRC
-        if crc_value != crc32(contents.read()):
+        if crc_value != crc32(contents):
             raise Exception('CRC is invalid! The file is corrupt!')
-        contents.seek(0)
-        end = False
-        while not end:
-            val = contents.read(1)
-            if val:
-                control = '{0:08b}'.format(ord(val))
-                # check bits from LSB to MSB
-                for i in range(1, 9):
-                    if control[-i] == '1':
-                        # token is reference (16 bit)
-                        token = uint16be(contents.read(2))  # big-endian
-                        if token is not None:
-                            # extract [12 bit offset][4 bit length]
-                            offset = (token >> 4) & 0b111111111111
-                            # end indicator
-                            end = write_offset == offset
-                            if not end:
-                                length = token & 0b1111
-                                actual_length = length + 2
-                                for step in range(actual_length):
-                                    read_offset = (offset + step) % MAX_DICT_SIZE
-                                    char = init_dict[read_offset]
-                                    output_buffer.append(bytes([char]) if PY3 else char)
-                                    init_dict[write_offset] = char
-                                    write_offset = (write_offset + 1) % MAX_DICT_SIZE
-                    else:
-                        # token is literal (8 bit)
-                        val = contents.read(1)
-                        if val:
-                            output_buffer.append(val)
-                            init_dict[write_offset] = ord(val) if PY3 else val
-                            write_offset = (write_offset + 1) % MAX_DICT_SIZE
-
-        return b"".join(output_buffer)
+        # appending is faster than writing through a cursor into bytearray(raw_size),
+        # and a corrupt raw size cannot force a huge allocation
+        output = bytearray()
+        LzfuWindow().decode(contents, 0, output, True)
+        return bytes(output)
     elif comp_type == UNCOMPRESSED:
-        return contents.read(raw_size)
+        return bytes(contents[0:raw_size])
     else:
         raise Exception('Unknown type of RTF compression!')
+
+
+def decompress_iter(stream, chunk_size=MAX_DICT_SIZE * 16):
+    """
+    Decompress RTF read from file-like `stream`, yielding chunks of the output,
+    the CRC is checked once the whole compressed data is read
+    """
+    header = stream.read(HEADER.size)
+    if header is None or len(header) < HEADER.size:
+        raise Exception('Data must be at least 16 bytes long')
+    comp_size, raw_size, comp_type, crc_value = HEADER.unpack(header)
+    remaining = max(comp_size - 12, 0)
+
+    if comp_type not in (COMPRESSED, UNCOMPRESSED):
+        raise Exception('Unknown type of RTF compression!')
+
+    window = LzfuWindow()
+    contents = bytearray()
+    output = bytearray()
+    crc = 0
+    while remaining > 0:
+        data = stream.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+
+        if comp_type == UNCOMPRESSED:
+            data = data[0:raw_size]
+            raw_size -= len(data)
+            if data:
+                yield bytes(data)
+            continue
+
+        crc = crc32(data, crc)
+        if window.done:
+            # keep reading for the CRC only
+            continue
+        contents += data
+        pos = window.decode(contents, 0, output, remaining == 0)
+        del contents[0:pos]
+        if len(output) >= chunk_size:
+            yield bytes(output)
+            del output[0:]
+
+    if comp_type == COMPRESSED:
+        if not window.done:
+            window.decode(contents, 0, output, True)
+        if output:
+            yield bytes(output)
+        if crc_value != crc:
+            raise Exception('CRC is invalid! The file is corrupt!')
+
+
+class LzfuWindow:
+    """
+    LZFu dictionary as a ring buffer preloaded with INIT_DICT, kept between
+    calls so compressed data can be decoded piecewise
+    """
+    __slots__ = ['ring', 'write_offset', 'done']
+
+    def __init__(self):
+        self.ring = bytearray(INIT_DICT + b' ' * (MAX_DICT_SIZE - INIT_DICT_SIZE))
+        self.write_offset = INIT_DICT_SIZE
+        self.done = False
+
+    def decode(self, contents, pos, output, final):
+        """
+        Decode `contents` from `pos` appending to `output` and return the position
+        reached, unless `final` it stops before a control byte whose tokens may be incomplete
+        """
+        ring = self.ring
+        write_offset = self.write_offset
+        end = len(contents)
+
+        while pos < end and not self.done:
+            if not final and end - pos < GROUP_SIZE:
+                break
+            control = contents[pos]
+            pos += 1
+            # check bits from LSB to MSB
+            for bit in range(8):
+                if control & (1 << bit):
+                    # token is reference (16 bit, big-endian) [12 bit offset][4 bit length]
+                    if pos + 1 >= end:
+                        self.done = True
+                        break
+                    token = (contents[pos] << 8) | contents[pos + 1]
+                    pos += 2
+                    offset = token >> 4
+                    # end indicator
+                    if offset == write_offset:
+                        self.done = True
+                        break
+                    length = (token & 0x0F) + 2
+                    if offset + length <= MAX_DICT_SIZE and write_offset + length <= MAX_DICT_SIZE and \
+                            (write_offset - offset) & DICT_MASK >= length:
+                        # source and target runs neither wrap nor overlap
+                        chunk = ring[offset:offset + length]
+                        ring[write_offset:write_offset + length] = chunk
+                        output += chunk
+                        write_offset = (write_offset + length) & DICT_MASK
+                    else:
+                        for step in range(length):
+                            char = ring[(offset + step) & DICT_MASK]
+                            output.append(char)
+                            ring[write_offset] = char
+                            write_offset = (write_offset + 1) & DICT_MASK
+                else:
+                    # token is literal (8 bit)
+                    if pos >= end:
+                        self.done = True
+                        break
+                    char = contents[pos]
+                    pos += 1
+                    output.append(char)
+                    ring[write_offset] = char
+                    write_offset = (write_offset + 1) & DICT_MASK
+
+        self.write_offset = write_offset
+        return pos
+
+
+def compress(data, compressed=True):
+    """
+    Compress `data` using RTF compression algorithm, or store it uncompressed
+    """
+    if not compressed:
+        return HEADER.pack(len(data) + 12, len(data), UNCOMPRESSED, 0) + bytes(data)
+    contents = _compress(bytes(data))
+    return HEADER.pack(len(contents) + 12, len(data), COMPRESSED, crc32(contents)) + contents
+
+
+def _compress(data):
+    # input follows INIT_DICT, so a position in `buf` masked is its offset in the dictionary
+    buf = INIT_DICT + data
+    end = len(buf)
+    # hash chains of 3-byte prefixes, `head` holds the last position of a prefix
+    # and `chain` the previous position with the same prefix
+    head = dict()
+    head_get = head.get
+    chain = array("i", [-1]) * end
+    last = end - MIN_MATCH
+    for pos in range(0, min(INIT_DICT_SIZE, last + 1)):
+        key = buf[pos:pos + MIN_MATCH]
+        chain[pos] = head_get(key, -1)
+        head[key] = pos
+
+    output = bytearray()
+    tokens = bytearray()
+    control = 0
+    bit = 0
+    pos = INIT_DICT_SIZE
+    while pos < end:
+        best = 0
+        best_pos = 0
+        limit = min(MAX_MATCH, end - pos)
+        if limit >= MIN_MATCH:
+            key = buf[pos:pos + MIN_MATCH]
+            previous = candidate = head_get(key, -1)
+            depth = MAX_CHAIN
+            # the dictionary holds the last 4096 bytes, but a reference to the
+            # write offset itself would be read as the end marker
+            while candidate >= 0 and pos - candidate < MAX_DICT_SIZE and depth:
+                if buf[candidate + best] == buf[pos + best]:
+                    length = MIN_MATCH
+                    while length < limit and buf[candidate + length] == buf[pos + length]:
+                        length += 1
+                    if length > best:
+                        best = length
+                        best_pos = candidate
+                        if length == limit:
+                            break
+                candidate = chain[candidate]
+                depth -= 1
+
+        if best:
+            # reference (16 bit, big-endian) [12 bit offset][4 bit length]
+            control |= 1 << bit
+            token = ((best_pos & DICT_MASK) << 4) | (best - 2)
+            tokens.append(token >> 8)
+            tokens.append(token & 0xFF)
+            step = best
+        else:
+            # literal (8 bit)
+            tokens.append(buf[pos])
+            step = 1
+
+        if limit >= MIN_MATCH:
+            chain[pos] = previous
+            head[key] = pos
+        for index in range(pos + 1, min(pos + step, last + 1)):
+            key = buf[index:index + MIN_MATCH]
+            chain[index] = head_get(key, -1)
+            head[key] = index
+        pos += step
+
+        bit += 1
+        if bit == 8:
+            output.append(control)
+            output += tokens
+            tokens.clear()
+            control = 0
+            bit = 0
+
+    # end marker is a reference to the write offset
+    control |= 1 << bit
+    token = (pos & DICT_MASK) << 4
+    tokens.append(token >> 8)
+    tokens.append(token & 0xFF)
+    output.append(control)
+    output += tokens
+    return bytes(output)
@@ -10,6 +10,20 @@ RTF_ASCII = re.compile(r"\\'([0-9a-fA-F]{2})(.*)", re.I)
 UNICODE = re.compile(r"\\u([0-9]{2,5})", re.I)
 HTML_TAG = re.compile(r"{\\\*\\m?htmltag[0-9]+", re.I)
 
+# tokens of HTML encapsulated in RTF: html tag groups, text runs, escaped braces,
+# hex escapes, \htmlrtf toggles, unicode characters, control words and symbols
+RTF_TOKEN = re.compile(
+    r"(?P<tag>(?i:{\\\*\\m?htmltag[0-9]+))"
+    r"|(?P<text>[^\\{}]+)"
+    r"|\\(?P<brace>(?!(?i:{\\\*\\m?htmltag[0-9]))[{}][^\s\\{}]*)"
+    r"|(?P<escape>\\'(?P<hex>[0-9a-fA-F]{2})(?P<rest>[^\s\\{}]*))"
+    r"|(?P<htmlrtf>(?i:\\htmlrtf)(?P<toggle>[01]?)[^\s\\{}]*)"
+    r"|(?P<unicode>\\[uU](?P<code>[0-9]{2,5})[^\s\\{}]*)"
+    r"|(?P<word>\\[a-zA-Z0-9][^\s\\{}]*)"
+    r"|(?P<symbol>\\[^\s\\{}]*)"
+    r"|[{}]"
+)
+
 # Translation of some special characters.
 SPECIAL_CHARS = {
     '\\par': '\n',
@@ -41,38 +55,52 @@ class RtfHtml:
         self.tags = []
 
     def export(self, rtf, decode_html=True):
-        lines = re.split(HTML_TAG, rtf)
-        for i in range(1, len(lines)):
-            tag = self.process_line(lines[i])
-            self.tags.append(self.make_html(tag, decode_html))
+        start = HTML_TAG.search(rtf)
+        if start is not None:
+            self.process(rtf, start.start(), decode_html)
         return "".join(self.substitute(tag) for tag in self.tags).strip()
 
-    def process_line(self, line):
-        word, words = [], []
-        for c in line:
-            n = len(word)
-            if c.isspace():
-                if n != 0:
-                    words.append("".join(word))
-                words.append(c)
-                word.clear()
-            elif c == "\\":
-                if n != 0:
-                    words.append("".join(word))
-                word.clear()
-                word.append(c)
-            elif c in ("{", "}"):
-                if n != 0:
-                    if word[-1] == "\\":
-                        word[-1] = c
-                    else:
-                        words.append("".join(word))
-                        word.clear()
+    def process(self, rtf, pos, decode_html):
+        html, toggle = None, decode_html
+        for match in RTF_TOKEN.finditer(rtf, pos):
+            kind = match.lastgroup
+            if kind == "tag":
+                if html is not None:
+                    self.tags.append("".join(html))
+                html, toggle = [], decode_html
+            elif kind == "htmlrtf":
+                toggle = match.group("toggle") == "0"
+            elif kind == "escape":
+                value = "%s%s" % (bytes([int(match.group("hex"), 16)]).decode(self.encoding), match.group("rest"))
+                toggle = self.make_word(value, html, toggle)
+            elif not toggle or kind is None or kind == "word" and match.group() not in SPECIAL_CHARS:
+                # skipped by \htmlrtf, group delimiters and control words without translation
+                continue
+            elif kind == "text" or kind == "symbol":
+                html.append(match.group())
+            elif kind == "word":
+                html.append(SPECIAL_CHARS[match.group()])
+            elif kind == "brace":
+                html.append(match.group("brace"))
             else:
-                word.append(c)
+                html.append("&#%s;" % match.group("code"))
+        if html is not None:
+            self.tags.append("".join(html))
 
-        words.append("".join(word))
-        return [self.substitute(w) for w in words]
+    @staticmethod
+    def make_word(word, html, toggle):
+        # decoded hex escape, which may itself read as a control word
+        match = HTML_RTF.match(word)
+        if match:
+            toggle = match.groups()[0] == '0'
+        elif toggle:
+            if RTF_WORD.match(word):
+                subst = SPECIAL_CHARS.get(word, None)
+                if subst is not None:
+                    html.append(subst)
+            else:
+                html.append(word)
+        return toggle
 
     def substitute(self, word):
         spec_char = SPECIAL_CHARS.get(word, None)
@@ -95,23 +123,6 @@ class RtfHtml:
 
         return word
 
-    @staticmethod
-    def make_html(words, toggle):
-        text = []
-        for i in range(0, len(words)):
-            match = HTML_RTF.match(words[i])
-            if match:
-                toggle = match.groups()[0] == '0'
-            elif toggle:
-                if RTF_WORD.match(words[i]):
-                    subst = SPECIAL_CHARS.get(words[i], None)
-                    if subst is not None:
-                        text.append(subst)
-                else:
-                    text.append(words[i])
-
-        return "".join(text)
-
 
 class RtfParser(RtfHtml):
     __slots__ = ['rtf', 'mime', 'encoding']
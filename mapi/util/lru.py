@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+
+__all__ = ['LruCache']
+
+
+class LruCache:
+    """
+    Bounded, thread safe mapping evicting the least recently used entry
+    """
+    __slots__ = ['max_size', 'entries', 'hits', 'misses', 'lock']
+
+    def __init__(self, max_size):
+        assert (max_size > 0)
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key, None)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return 0.0 if total == 0 else self.hits / total
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,98 @@
+"""
+Content addressed store of attachment data, blobs are named by their SHA-256
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+__all__ = ['ContentStore']
+
+HEAD_SIZE = 4096
+# (size, head digest) to blob digest lines, so a reopened store knows its blobs
+HEADS_FILE = "heads"
+
+
+class ContentStore:
+    """
+    Blobs are indexed by size and hash of their head: content with an unknown
+    key is hashed while written, otherwise it is hashed first and written only if new.
+    The index is appended to a file in the store and loaded when it is reopened
+    """
+    __slots__ = ['root', 'head_size', 'heads', 'written', 'duplicates', 'lock']
+
+    def __init__(self, root, head_size=HEAD_SIZE):
+        self.root = root
+        self.head_size = head_size
+        self.heads = dict()
+        self.written = 0
+        self.duplicates = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[0:2], digest[2:])
+
+    def add(self, size, head, chunks):
+        """
+        Add the content of `size` bytes starting with `head`, `chunks` is called
+        to get an iterator over the whole content and may be called twice
+        """
+        key = (size, hashlib.sha256(head[0:self.head_size]).digest())
+        with self.lock:
+            candidates = self.heads.get(key, None)
+
+        if candidates is not None:
+            digest = hashlib.sha256()
+            for chunk in chunks():
+                digest.update(chunk)
+            digest = digest.hexdigest()
+            if os.path.exists(self.path(digest)):
+                self._index(key, digest, False)
+                return digest
+
+        digest, written = self._write(chunks())
+        self._index(key, digest, written)
+        return digest
+
+    def _write(self, chunks):
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as fp:
+            for chunk in chunks:
+                digest.update(chunk)
+                fp.write(chunk)
+        digest = digest.hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(fp.name)
+            written = False
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(fp.name, path)
+            written = True
+        return digest, written
+
+    def _load(self):
+        path = os.path.join(self.root, HEADS_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) == 3:
+                    key = (int(fields[0]), bytes.fromhex(fields[1]))
+                    self.heads.setdefault(key, set()).add(fields[2])
+
+    def _index(self, key, digest, written):
+        with self.lock:
+            candidates = self.heads.setdefault(key, set())
+            if digest not in candidates:
+                candidates.add(digest)
+                with open(os.path.join(self.root, HEADS_FILE), "a") as fp:
+                    fp.write("%d %s %s\n" % (key[0], key[1].hex(), digest))
+            if written:
+                self.written += 1
+            else:
+                self.duplicates += 1
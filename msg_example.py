@@ -19,17 +19,15 @@ def extract_attachments(mapi, location="./"):
         if attachment_name is None:
             log.warn("attachment %d unknown attachment name!" % i)
             attachment_name = "unknown-%d" % i
-        data = attachments[i].get_attachment()
-        if data is None:
+        written = attachments[i].save_to(location + attachment_name)
+        if written is None:
             log.warn("attachment %d found no data!" % i)
         else:
-            with open(location + attachment_name, "wb") as f:
-                written = f.write(data)
-                log.info("attachment: %d name: %s content id: %s size: %s" %
-                         (attachments[i].get_attachment_number(),
-                          attachment_name,
-                          attachments[i].get_display_name(),
-                          written))
+            log.info("attachment: %d name: %s content id: %s size: %s" %
+                     (attachments[i].get_attachment_number(),
+                      attachment_name,
+                      attachments[i].get_display_name(),
+                      written))
 
 
 if __name__ == '__main__':